@@ -1457,17 +1457,19 @@ class CompetitiveLiftingData {
             return nil
         }
         
-        // Find where this weight falls in the percentile distribution
-        let percentileKeys = liftData.percentiles.keys.compactMap { Int($0) }.sorted()
+        // Weights are listed in the same order as metadata.percentiles
+        let percentileKeys = data.metadata.percentiles
+        let weights = liftData.percentiles
+        guard weights.count == percentileKeys.count else {
+            return nil
+        }
         
+        // Find where this weight falls in the percentile distribution
         for i in 0..<percentileKeys.count - 1 {
             let lowerPercentile = percentileKeys[i]
             let upperPercentile = percentileKeys[i + 1]
-            
-            guard let lowerWeight = liftData.percentiles[String(lowerPercentile)],
-                  let upperWeight = liftData.percentiles[String(upperPercentile)] else {
-                continue
-            }
+            let lowerWeight = weights[i]
+            let upperWeight = weights[i + 1]
             
             if weight >= lowerWeight && weight < upperWeight {
                 // Linear interpolation
@@ -1478,14 +1480,14 @@ class CompetitiveLiftingData {
         
         // Below minimum
         if let firstPercentile = percentileKeys.first,
-           let firstWeight = liftData.percentiles[String(firstPercentile)],
+           let firstWeight = weights.first,
            weight < firstWeight {
             return max(1, Double(firstPercentile) * (weight / firstWeight))
         }
         
         // Above maximum
         if let lastPercentile = percentileKeys.last,
-           let lastWeight = liftData.percentiles[String(lastPercentile)],
+           let lastWeight = weights.last,
            weight >= lastWeight {
             return min(99.9, Double(lastPercentile))
         }
@@ -1541,7 +1543,8 @@ struct WeightClassData: Codable {
 
 struct LiftPercentileData: Codable {
     let count: Int
-    let percentiles: [String: Double]
+    /// Weights (kg) at each of `PowerliftingMetadata.percentiles`, in the same order
+    let percentiles: [Double]
 }
 
 // MARK: - Strength Scores Calculator (WILKS, DOTS, IPF GL)
@@ -6,7 +6,15 @@ This script downloads and processes the OpenPowerlifting CSV data to create
 compact percentile lookup tables for use in the iOS app.
 
 Usage:
-    python3 generate_powerlifting_percentiles.py
+    python3 generate_powerlifting_percentiles.py [--cache PATH | --no-cache] [--pretty]
+
+The downloaded archive is cached (by default under ~/.cache/top_set/) and only
+downloaded again when the server reports a newer copy.
+
+The JSON is written compactly; pass --pretty for an indented, diffable file.
+
+Requirements:
+    numpy, pandas (orjson is used for faster JSON output when installed)
 
 Output:
     ../Resources/powerlifting_percentiles.json
@@ -16,15 +24,24 @@ Data source: https://openpowerlifting.gitlab.io/opl-csv/
 
 import json
 import os
+import shutil
 import ssl
 import sys
+import tempfile
 import urllib.request
 import zipfile
-from collections import defaultdict
-from io import BytesIO
+from argparse import ArgumentParser
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from typing import IO
+
+import numpy as np
+import pandas as pd
 
-import csv
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Create SSL context that doesn't verify certificates (for macOS compatibility)
 ssl_context = ssl.create_default_context()
@@ -34,6 +51,9 @@ ssl_context.verify_mode = ssl.CERT_NONE
 # OpenPowerlifting data URL
 OPL_URL = "https://openpowerlifting.gitlab.io/opl-csv/files/openpowerlifting-latest.zip"
 
+# Where the downloaded archive is cached between runs
+CACHE_PATH = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'top_set' / 'openpowerlifting-latest.zip'
+
 # Weight classes (in kg) - IPF standard classes
 MALE_WEIGHT_CLASSES = [59, 66, 74, 83, 93, 105, 120, 140]  # 140+ is SHW
 FEMALE_WEIGHT_CLASSES = [47, 52, 57, 63, 69, 76, 84, 100]  # 100+ is SHW
@@ -48,183 +68,248 @@ AGE_BRACKETS = [
     (70, 999, "masters_70"),
 ]
 
+# Lookup tables for classifying whole columns at once
+MALE_WEIGHT_CLASS_NAMES = [*(str(wc) for wc in MALE_WEIGHT_CLASSES), f"{MALE_WEIGHT_CLASSES[-1]}+"]
+FEMALE_WEIGHT_CLASS_NAMES = [*(str(wc) for wc in FEMALE_WEIGHT_CLASSES), f"{FEMALE_WEIGHT_CLASSES[-1]}+"]
+AGE_BRACKET_MIN_AGES = [min_age for min_age, _, _ in AGE_BRACKETS]
+AGE_BRACKET_NAMES = [bracket for _, _, bracket in AGE_BRACKETS]
+
+# Weight class index for each whole kg of bodyweight, one row per sex (male, female)
+WEIGHT_CLASS_TABLE = np.array([
+    np.searchsorted(classes, np.arange(max(MALE_WEIGHT_CLASSES[-1], FEMALE_WEIGHT_CLASSES[-1]) + 2), side='left')
+    for classes in (MALE_WEIGHT_CLASSES, FEMALE_WEIGHT_CLASSES)
+])
+
+# Age bracket index for each whole year of age
+AGE_BRACKET_TABLE = np.searchsorted(AGE_BRACKET_MIN_AGES, np.arange(AGE_BRACKET_MIN_AGES[-1] + 1), side='right') - 1
+
+# Bracket for lifters without a usable age; they only count towards "all ages"
+UNKNOWN_AGE_BRACKET = "unknown"
+
+# Every lifter is classified into one integer group id combining these
+WEIGHT_CLASS_COUNT = max(len(MALE_WEIGHT_CLASS_NAMES), len(FEMALE_WEIGHT_CLASS_NAMES))
+GROUP_AGE_BRACKETS = [*AGE_BRACKET_NAMES, UNKNOWN_AGE_BRACKET]
+GROUP_COUNT = 2 * WEIGHT_CLASS_COUNT * len(GROUP_AGE_BRACKETS)
+
+# Numeric columns read from the OpenPowerlifting CSV (alongside Sex)
+NUMERIC_COLUMNS = ['BodyweightKg', 'Age', 'Best3SquatKg', 'Best3BenchKg', 'Best3DeadliftKg']
+
+# Lifts to report, and the CSV column holding each lifter's best attempt
+LIFT_COLUMNS = {
+    "squat": 'Best3SquatKg',
+    "bench": 'Best3BenchKg',
+    "deadlift": 'Best3DeadliftKg',
+}
+
 # Percentiles to calculate
 PERCENTILES = [5, 10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99]
 
 
-def download_data() -> str:
-    """Download and extract the OpenPowerlifting CSV."""
+def get_remote_last_modified() -> float | None:
+    """Get the Last-Modified time of the archive on the server, if it reports one."""
+    request = urllib.request.Request(OPL_URL, method='HEAD')
+    with urllib.request.urlopen(request, context=ssl_context) as response:
+        last_modified = response.headers.get('Last-Modified')
+    
+    if not last_modified:
+        return None
+    return parsedate_to_datetime(last_modified).timestamp()
+
+
+def fetch_archive(destination: IO[bytes]):
+    """Stream the OpenPowerlifting zip file into an open binary file."""
     print("Downloading OpenPowerlifting data...")
     print("(This may take a few minutes - the file is ~100MB)")
     
-    # Download the zip file
+    # Copy in chunks rather than holding the whole archive in memory
     with urllib.request.urlopen(OPL_URL, context=ssl_context) as response:
-        zip_data = BytesIO(response.read())
-    
-    print("Extracting...")
-    
-    # Extract the CSV
-    with zipfile.ZipFile(zip_data) as zf:
-        # Find the main CSV file
-        csv_files = [f for f in zf.namelist() if f.endswith('.csv') and 'openpowerlifting' in f.lower()]
-        if not csv_files:
-            # Try to find any CSV
-            csv_files = [f for f in zf.namelist() if f.endswith('.csv')]
-        
-        if not csv_files:
-            raise ValueError("No CSV file found in the archive")
+        shutil.copyfileobj(response, destination, 1 << 20)
+
+
+def download_data(cache_path: Path | None = CACHE_PATH) -> zipfile.ZipFile:
+    """Download (or reuse a cached copy of) the OpenPowerlifting archive and open it."""
+    if cache_path is None:
+        # No cache: the anonymous temporary file is removed when it is closed
+        zip_file = tempfile.TemporaryFile(suffix='.zip')
+        fetch_archive(zip_file)
+        zip_file.seek(0)
+    else:
+        try:
+            last_modified = get_remote_last_modified()
+            is_fresh = (
+                cache_path.exists()
+                and last_modified is not None
+                and cache_path.stat().st_mtime >= last_modified
+            )
+        except OSError as e:
+            # Offline or the server is unreachable; fall back to the cache if we have one
+            if not cache_path.exists():
+                raise
+            print(f"Could not check for newer data ({e}), using cached copy")
+            is_fresh = True
         
-        csv_file = csv_files[0]
-        print(f"Processing {csv_file}...")
+        if is_fresh:
+            print(f"Using cached data from {cache_path}")
+        else:
+            # Download next to the cache and move it into place once complete,
+            # so an interrupted download never leaves a truncated archive behind
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            partial_path = cache_path.with_suffix('.part')
+            with open(partial_path, 'wb') as f:
+                fetch_archive(f)
+            os.replace(partial_path, cache_path)
+            if last_modified is not None:
+                os.utime(cache_path, (last_modified, last_modified))
         
-        with zf.open(csv_file) as f:
-            return f.read().decode('utf-8')
+        zip_file = cache_path
+    
+    return zipfile.ZipFile(zip_file)
 
 
-def get_weight_class(bodyweight: float, is_male: bool) -> str | None:
-    """Get the weight class for a given bodyweight."""
-    classes = MALE_WEIGHT_CLASSES if is_male else FEMALE_WEIGHT_CLASSES
+def open_csv(zf: zipfile.ZipFile) -> IO[bytes]:
+    """Open the main OpenPowerlifting CSV inside the archive for streaming."""
+    print("Extracting...")
     
-    for wc in classes:
-        if bodyweight <= wc:
-            return str(wc)
+    # Find the main CSV file
+    csv_files = [f for f in zf.namelist() if f.endswith('.csv') and 'openpowerlifting' in f.lower()]
+    if not csv_files:
+        # Try to find any CSV
+        csv_files = [f for f in zf.namelist() if f.endswith('.csv')]
     
-    # Super heavyweight
-    return f"{classes[-1]}+"
+    if not csv_files:
+        raise ValueError("No CSV file found in the archive")
+    
+    csv_file = csv_files[0]
+    print(f"Processing {csv_file}...")
+    
+    # The member is decompressed incrementally as pandas reads from it
+    return zf.open(csv_file)
 
 
-def get_age_bracket(age: float) -> str | None:
-    """Get the age bracket for a given age."""
-    for min_age, max_age, bracket in AGE_BRACKETS:
-        if min_age <= age <= max_age:
-            return bracket
-    return None
+def get_weight_class(bodyweight: np.ndarray, is_male: np.ndarray) -> np.ndarray:
+    """Get the index into the sex's weight class names for each bodyweight."""
+    # Rounding up keeps each (whole kg) class limit inside its class; anything
+    # past the end of the table is super heavyweight
+    kg = np.clip(np.ceil(bodyweight), 0, WEIGHT_CLASS_TABLE.shape[1] - 1).astype(np.intp)
+    return WEIGHT_CLASS_TABLE[np.where(is_male, 0, 1), kg]
 
 
-def calculate_percentile(values: list[float], percentile: int) -> float:
-    """Calculate the given percentile from a list of values."""
-    if not values:
-        return 0.0
-    
-    sorted_values = sorted(values)
-    index = (len(sorted_values) - 1) * percentile / 100
-    lower = int(index)
-    upper = lower + 1
-    
-    if upper >= len(sorted_values):
-        return sorted_values[-1]
+def get_age_bracket(age: np.ndarray) -> np.ndarray:
+    """Get the index into GROUP_AGE_BRACKETS for each age (UNKNOWN_AGE_BRACKET when there isn't one)."""
+    # Any age past the end of the table falls in the last bracket
+    unknown = np.isnan(age) | (age < 0)
+    years = np.where(unknown, 0, np.minimum(age, len(AGE_BRACKET_TABLE) - 1)).astype(np.intp)
+    brackets = AGE_BRACKET_TABLE[years]
+    brackets[unknown] = len(AGE_BRACKET_NAMES)
+    return brackets
+
+
+def get_group_ids(is_male: np.ndarray, bodyweight: np.ndarray, age: np.ndarray) -> np.ndarray:
+    """Classify each lifter into a single (sex, weight class, age bracket) group id."""
+    sex = np.where(is_male, 0, 1)
+    weight_class = get_weight_class(bodyweight, is_male)
+    age_bracket = get_age_bracket(age)
+    group_ids = (sex * WEIGHT_CLASS_COUNT + weight_class) * len(GROUP_AGE_BRACKETS) + age_bracket
     
+    # Small integer ids let numpy use a radix sort when ordering lifters by group
+    return group_ids.astype(np.int16)
+
+
+def decode_group_id(group_id: int) -> tuple[str, str, str]:
+    """Get the (sex, weight class, age bracket) keys for a group id."""
+    sex_weight_class, age_bracket = divmod(group_id, len(GROUP_AGE_BRACKETS))
+    sex, weight_class = divmod(sex_weight_class, WEIGHT_CLASS_COUNT)
+    weight_class_names = MALE_WEIGHT_CLASS_NAMES if sex == 0 else FEMALE_WEIGHT_CLASS_NAMES
+    return ("male", "female")[sex], weight_class_names[weight_class], GROUP_AGE_BRACKETS[age_bracket]
+
+
+def calculate_percentiles(values: np.ndarray) -> list[float]:
+    """Calculate all PERCENTILES (in that order) from an array of values in a single pass."""
+    # Sort once and interpolate linearly between the neighbouring ranks.
+    # numpy's vectorized sort is several times faster than the multi-kth
+    # partition np.percentile does for a dozen percentiles.
+    sorted_values = np.sort(values)
+    index = (len(sorted_values) - 1) * np.array(PERCENTILES) / 100
+    lower = index.astype(np.intp)
+    upper = np.minimum(lower + 1, len(sorted_values) - 1)
     weight = index - lower
-    return sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+    pcts = sorted_values[lower] * (1 - weight) + sorted_values[upper] * weight
+    return np.round(pcts, 1).tolist()
 
 
-def process_data(csv_content: str) -> dict:
+def process_data(csv_file: IO[bytes]) -> dict:
     """Process the CSV data and generate percentile tables."""
     
-    # Data structure: {sex: {weight_class: {age_bracket: {lift: [values]}}}}
-    data: dict[str, dict[str, dict[str, dict[str, list[float]]]]] = {
-        "male": defaultdict(lambda: defaultdict(lambda: defaultdict(list))),
-        "female": defaultdict(lambda: defaultdict(lambda: defaultdict(list))),
+    # Data structure: {sex: {weight_class: {age_bracket: {lift: ndarray}}}}
+    # Lift values are kept in contiguous float32 arrays; kg values are
+    # recorded to 0.1 so float32 is plenty. Each lifter is stored once, so
+    # "all ages" is the concatenation of a weight class's brackets
+    # (including UNKNOWN_AGE_BRACKET).
+    data: dict[str, dict[str, dict[str, dict[str, np.ndarray]]]] = {
+        "male": {},
+        "female": {},
     }
     
-    # Also collect "all ages" data
-    all_ages_data: dict[str, dict[str, dict[str, list[float]]]] = {
-        "male": defaultdict(lambda: defaultdict(list)),
-        "female": defaultdict(lambda: defaultdict(list)),
-    }
+    # Parse only the columns we need, in C, straight from the zip member
+    df = pd.read_csv(
+        csv_file,
+        usecols=['Sex', *NUMERIC_COLUMNS],
+        dtype={'Sex': 'category'},
+        engine='c',
+    )
+    row_count = len(df)
     
-    reader = csv.DictReader(csv_content.splitlines())
+    # Coerce each numeric column once; unparseable values become NaN and are
+    # filtered out below like any other missing value
+    for column in NUMERIC_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce', downcast='float')
     
-    row_count = 0
-    included_count = 0
+    # All lifts as one (lift, lifter) matrix, rows in LIFT_COLUMNS order, so
+    # each lift's values stay contiguous. Missing lifts parse as NaN and
+    # failed ones are negative; a single "> 0" test rejects both (NaN
+    # compares false)
+    lifts = df[list(LIFT_COLUMNS.values())].to_numpy(np.float32).T
     
-    for row in reader:
-        row_count += 1
-        if row_count % 100000 == 0:
-            print(f"  Processed {row_count:,} rows...")
-        
-        # Filter criteria
-        # - Must have bodyweight
-        # - Must have at least one lift
-        # - Prefer tested federations, but include all for larger sample
-        
-        try:
-            bodyweight_str = row.get('BodyweightKg', '')
-            if not bodyweight_str:
-                continue
-            bodyweight = float(bodyweight_str)
-            
-            sex = row.get('Sex', '').lower()
-            if sex not in ('m', 'f'):
-                continue
-            
-            is_male = sex == 'm'
-            sex_key = "male" if is_male else "female"
-            
-            weight_class = get_weight_class(bodyweight, is_male)
-            if not weight_class:
-                continue
-            
-            # Get age bracket (optional)
-            age_str = row.get('Age', '')
-            age_bracket = None
-            if age_str:
-                try:
-                    age = float(age_str)
-                    age_bracket = get_age_bracket(age)
-                except ValueError:
-                    pass
-            
-            # Get best lifts (in kg)
-            squat = row.get('Best3SquatKg', '')
-            bench = row.get('Best3BenchKg', '')
-            deadlift = row.get('Best3DeadliftKg', '')
-            
-            # Store valid lifts
-            lifts_added = False
-            
-            if squat and not squat.startswith('-'):
-                try:
-                    squat_val = float(squat)
-                    if squat_val > 0:
-                        all_ages_data[sex_key][weight_class]["squat"].append(squat_val)
-                        if age_bracket:
-                            data[sex_key][weight_class][age_bracket]["squat"].append(squat_val)
-                        lifts_added = True
-                except ValueError:
-                    pass
-            
-            if bench and not bench.startswith('-'):
-                try:
-                    bench_val = float(bench)
-                    if bench_val > 0:
-                        all_ages_data[sex_key][weight_class]["bench"].append(bench_val)
-                        if age_bracket:
-                            data[sex_key][weight_class][age_bracket]["bench"].append(bench_val)
-                        lifts_added = True
-                except ValueError:
-                    pass
-            
-            if deadlift and not deadlift.startswith('-'):
-                try:
-                    deadlift_val = float(deadlift)
-                    if deadlift_val > 0:
-                        all_ages_data[sex_key][weight_class]["deadlift"].append(deadlift_val)
-                        if age_bracket:
-                            data[sex_key][weight_class][age_bracket]["deadlift"].append(deadlift_val)
-                        lifts_added = True
-                except ValueError:
-                    pass
-            
-            if lifts_added:
-                included_count += 1
-                
-        except (ValueError, KeyError):
-            continue
+    # Filter criteria
+    # - Must have bodyweight
+    # - Must have at least one lift
+    # - Prefer tested federations, but include all for larger sample
+    keep = (
+        df['BodyweightKg'].notna().to_numpy()
+        & df['Sex'].isin(('M', 'F')).to_numpy()
+        & (lifts > 0).any(axis=0)
+    )
+    df = df[keep]
+    lifts = lifts[:, keep]
+    
+    included_count = len(df)
+    
+    group_ids = get_group_ids(
+        (df['Sex'] == 'M').to_numpy(),
+        df['BodyweightKg'].to_numpy(),
+        df['Age'].to_numpy(),
+    )
+    
+    # Count the lifters in each group, then gather the lift matrix once into a
+    # buffer ordered by group, so every group's values are a contiguous slice
+    counts = np.bincount(group_ids, minlength=GROUP_COUNT)
+    ends = np.cumsum(counts)
+    order = np.argsort(group_ids, kind='stable')
+    lifts = lifts.take(order, axis=1)
+    
+    for group_id in np.flatnonzero(counts):
+        sex_key, wc, bracket = decode_group_id(group_id)
+        group_data = data[sex_key].setdefault(wc, {}).setdefault(bracket, {})
+        group_lifts = lifts[:, ends[group_id] - counts[group_id]:ends[group_id]]
+        group_valid = group_lifts > 0
+        for i, lift in enumerate(LIFT_COLUMNS):
+            group_data[lift] = group_lifts[i][group_valid[i]]
     
     print(f"Processed {row_count:,} total rows, included {included_count:,} lifters")
     
-    # Generate percentile tables
+    # Generate percentile tables. This runs serially on purpose: sorting every
+    # group for the full dataset takes ~0.1s, less than it would cost to ship
+    # the arrays to worker processes, and parsing dominates the run anyway.
     result = {
         "metadata": {
             "source": "OpenPowerlifting",
@@ -238,64 +323,68 @@ def process_data(csv_content: str) -> dict:
         "female": {},
     }
     
-    for sex_key in ["male", "female"]:
-        weight_classes = MALE_WEIGHT_CLASSES if sex_key == "male" else FEMALE_WEIGHT_CLASSES
-        
-        for wc in weight_classes:
-            wc_str = str(wc)
-            wc_plus = f"{wc}+"
+    # Groups were filled in id order, so weight classes and age brackets
+    # iterate in ascending order
+    for sex_key, weight_classes in data.items():
+        for weight_class_key, age_brackets in weight_classes.items():
+            wc_data = {
+                "all_ages": {},
+                "by_age": {},
+            }
             
-            for weight_class_key in [wc_str, wc_plus]:
-                if weight_class_key not in all_ages_data[sex_key]:
+            # All ages percentiles
+            for lift in LIFT_COLUMNS:
+                values = np.concatenate([bracket_lifts[lift] for bracket_lifts in age_brackets.values()])
+                if len(values) >= 50:  # Minimum sample size
+                    wc_data["all_ages"][lift] = {
+                        "count": len(values),
+                        "percentiles": calculate_percentiles(values),
+                    }
+            
+            # By age bracket
+            for age_bracket, bracket_lifts in age_brackets.items():
+                if age_bracket == UNKNOWN_AGE_BRACKET:
                     continue
                 
-                wc_data = {
-                    "all_ages": {},
-                    "by_age": {},
-                }
-                
-                # All ages percentiles
-                for lift in ["squat", "bench", "deadlift"]:
-                    values = all_ages_data[sex_key][weight_class_key][lift]
-                    if len(values) >= 50:  # Minimum sample size
-                        wc_data["all_ages"][lift] = {
+                age_data = {}
+                for lift, values in bracket_lifts.items():
+                    if len(values) >= 30:  # Minimum sample size for age brackets
+                        age_data[lift] = {
                             "count": len(values),
-                            "percentiles": {
-                                str(p): round(calculate_percentile(values, p), 1)
-                                for p in PERCENTILES
-                            }
+                            "percentiles": calculate_percentiles(values),
                         }
                 
-                # By age bracket
-                for age_bracket in [ab[2] for ab in AGE_BRACKETS]:
-                    if weight_class_key not in data[sex_key]:
-                        continue
-                    if age_bracket not in data[sex_key][weight_class_key]:
-                        continue
-                    
-                    age_data = {}
-                    for lift in ["squat", "bench", "deadlift"]:
-                        values = data[sex_key][weight_class_key][age_bracket][lift]
-                        if len(values) >= 30:  # Minimum sample size for age brackets
-                            age_data[lift] = {
-                                "count": len(values),
-                                "percentiles": {
-                                    str(p): round(calculate_percentile(values, p), 1)
-                                    for p in PERCENTILES
-                                }
-                            }
-                    
-                    if age_data:
-                        wc_data["by_age"][age_bracket] = age_data
-                
-                if wc_data["all_ages"]:
-                    result[sex_key][weight_class_key] = wc_data
+                if age_data:
+                    wc_data["by_age"][age_bracket] = age_data
+            
+            if wc_data["all_ages"]:
+                result[sex_key][weight_class_key] = wc_data
     
     return result
 
 
+def write_json(result: dict, output_path: Path, pretty: bool = False):
+    """Write the percentile tables as JSON, indented only if pretty is set."""
+    if orjson is not None:
+        output_path.write_bytes(orjson.dumps(result, option=orjson.OPT_INDENT_2 if pretty else 0))
+    else:
+        with open(output_path, 'w') as f:
+            if pretty:
+                json.dump(result, f, indent=2)
+            else:
+                json.dump(result, f, separators=(',', ':'))
+
+
 def main():
-    # Check if we should use cached data
+    parser = ArgumentParser(description="Generate powerlifting percentile tables from OpenPowerlifting data")
+    parser.add_argument('--cache', type=Path, default=CACHE_PATH,
+                        help=f"where to cache the downloaded archive (default: {CACHE_PATH})")
+    parser.add_argument('--no-cache', action='store_true',
+                        help="always download a fresh copy and don't keep it")
+    parser.add_argument('--pretty', action='store_true',
+                        help="indent the output JSON")
+    args = parser.parse_args()
+    
     script_dir = Path(__file__).parent
     output_path = script_dir.parent / "Resources" / "powerlifting_percentiles.json"
     
@@ -305,7 +394,8 @@ def main():
     print()
     
     try:
-        csv_content = download_data()
+        zf = download_data(None if args.no_cache else args.cache)
+        csv_file = open_csv(zf)
     except Exception as e:
         print(f"Error downloading data: {e}")
         print("\nYou can manually download from:")
@@ -313,12 +403,12 @@ def main():
         sys.exit(1)
     
     print("\nCalculating percentiles...")
-    result = process_data(csv_content)
+    with zf, csv_file:
+        result = process_data(csv_file)
     
     # Save to JSON
     output_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(output_path, 'w') as f:
-        json.dump(result, f, indent=2)
+    write_json(result, output_path, pretty=args.pretty)
     
     print(f"\nSaved to: {output_path}")
     print(f"File size: {output_path.stat().st_size / 1024:.1f} KB")